@@ -155,18 +155,14 @@ class BaichuanConvert(BaseModelConvert):
         pool = multiprocessing.Pool(processes)
         for name, param in model_named_parameters.items():
             if name == "model.embed_tokens.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(os.path.join(output_dir, "model.wte.bin"))
+                self.to_np(param).tofile(os.path.join(output_dir, "model.wte.bin"))
             elif name == "model.norm.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.final_layernorm.weight.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.final_layernorm.weight.bin"))
             # elif name == 'model.final_layernorm.bias':
-            #     param.detach().cpu().numpy().astype(self.dtype).tofile(
+            #     self.to_np(param).tofile(
             #         os.path.join(output_dir, "model.final_layernorm.bias.bin"))
             elif name == "lm_head.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.lm_head.weight.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.lm_head.weight.bin"))
             else:
                 starmap_args = []
                 for i in range(len(hf_model_name_pattern)):
@@ -179,7 +175,7 @@ class BaichuanConvert(BaseModelConvert):
                                 output_dir,
                                 factor,
                                 new_name,
-                                param.detach().cpu().numpy().astype(self.dtype),
+                                self.to_np(param),
                             )
                         )
                 pool.starmap_async(self.split_and_convert_process, starmap_args)
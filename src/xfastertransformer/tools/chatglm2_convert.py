@@ -211,15 +211,11 @@ class ChatGLM2Convert(BaseModelConvert):
         pool = multiprocessing.Pool(processes)
         for name, param in model_named_parameters.items():
             if name == "transformer.embedding.word_embeddings.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(os.path.join(output_dir, "model.wte.bin"))
+                self.to_np(param).tofile(os.path.join(output_dir, "model.wte.bin"))
             elif name == "transformer.encoder.final_layernorm.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.final_layernorm.weight.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.final_layernorm.weight.bin"))
             elif name == "transformer.output_layer.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.lm_head.weight.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.lm_head.weight.bin"))
             else:
                 starmap_args = []
                 for i in range(len(huggingface_model_name_pattern)):
@@ -234,7 +230,7 @@ class ChatGLM2Convert(BaseModelConvert):
                                 output_dir,
                                 factor,
                                 new_name,
-                                param.detach().cpu().numpy().astype(self.dtype),
+                                self.to_np(param),
                                 num_attention_heads,
                                 multi_query_group_num,
                                 kv_channels,
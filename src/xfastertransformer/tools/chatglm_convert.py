@@ -180,19 +180,13 @@ class ChatGLMConvert(BaseModelConvert):
         pool = multiprocessing.Pool(processes)
         for name, param in model_named_parameters.items():
             if name == "transformer.word_embeddings.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(os.path.join(output_dir, "model.wte.bin"))
+                self.to_np(param).tofile(os.path.join(output_dir, "model.wte.bin"))
             elif name == "transformer.final_layernorm.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.final_layernorm.weight.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.final_layernorm.weight.bin"))
             elif name == "transformer.final_layernorm.bias":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.final_layernorm.bias.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.final_layernorm.bias.bin"))
             elif name == "lm_head.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.lm_head.weight.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.lm_head.weight.bin"))
             else:
                 starmap_args = []
                 for i in range(len(huggingface_model_name_pattern)):
@@ -207,7 +201,7 @@ class ChatGLMConvert(BaseModelConvert):
                                 output_dir,
                                 factor,
                                 new_name,
-                                param.detach().cpu().numpy().astype(self.dtype),
+                                self.to_np(param),
                             )
                         )
                 pool.starmap_async(self.split_and_convert_process, starmap_args)
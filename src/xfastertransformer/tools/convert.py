@@ -12,13 +12,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ============================================================================
+import functools
 import numpy as np
 import os
 from pathlib import Path
 import json
+import torch
 import traceback
 import transformers
 
+from concurrent.futures import FIRST_COMPLETED, wait
 from typing import Any, Callable, ContextManager, Iterator, Sequence, TypeVar, cast
 
 
@@ -41,15 +44,20 @@ def check_transformers_version_compatibility(token_path):
                 )
 
 
+def has_safetensors(model_dir: Path):
+    return any(f.endswith(".safetensors") for f in os.listdir(model_dir))
+
+
 def get_name_and_param(model_dir: Path):
-    all_files = os.listdir(model_dir)
-    safetensors_files = [f for f in all_files if f.endswith(".safetensors")]
-    num_parts = len(safetensors_files)
-    file_list = (
-        [f"model-{n:05}-of-{num_parts:05}.safetensors" for n in range(1, num_parts + 1)]
-        if num_parts > 1
-        else safetensors_files
-    )
+    index_path = os.path.join(model_dir, "model.safetensors.index.json")
+    if os.path.exists(index_path):
+        # sharded checkpoint, only read the shards referenced by the index
+        with open(index_path, "r") as file:
+            weight_map = json.load(file)["weight_map"]
+        file_list = sorted(set(weight_map.values()))
+    else:
+        file_list = sorted(f for f in os.listdir(model_dir) if f.endswith(".safetensors"))
+    num_parts = len(file_list)
     print(f"Found {num_parts} model parts: {file_list}")
     for part_name in file_list:
         ctx: ContextManager[Any]
@@ -64,6 +72,53 @@ def get_name_and_param(model_dir: Path):
                 yield name, model_part.get_tensor(name)
 
 
+# Local filesystems implementing fallocate natively. On others (e.g. NFS) glibc emulates posix_fallocate by
+# writing every block, which is far slower than the write it is meant to speed up.
+FALLOCATE_FILESYSTEMS = {"ext4", "xfs", "btrfs"}
+# Small files gain nothing from preallocation.
+FALLOCATE_MIN_BYTES = 64 << 20
+
+
+@functools.lru_cache(maxsize=None)
+def get_filesystem_type(dir_path: str):
+    try:
+        with open("/proc/mounts", "r") as file:
+            mounts = [line.split()[1:3] for line in file]
+    except OSError:
+        return None
+    # the longest mount point containing dir_path is the filesystem it lives on
+    mount_point, fs_type = "", None
+    for point, point_type in mounts:
+        if (dir_path == point or dir_path.startswith(point.rstrip("/") + "/")) and len(point) > len(mount_point):
+            mount_point, fs_type = point, point_type
+    return fs_type
+
+
+def write_array(val: np.ndarray, path):
+    # One large buffered write of a C-contiguous array instead of ndarray.tofile().
+    val = np.ascontiguousarray(val)
+    preallocate = (
+        hasattr(os, "posix_fallocate")
+        and val.nbytes >= FALLOCATE_MIN_BYTES
+        and get_filesystem_type(os.path.dirname(os.path.realpath(path))) in FALLOCATE_FILESYSTEMS
+    )
+    with open(path, "wb", buffering=1 << 22) as f:
+        # Reserve large files up front so the filesystem can allocate contiguous extents.
+        if preallocate:
+            os.posix_fallocate(f.fileno(), 0, val.nbytes)
+        f.write(memoryview(val).cast("B"))
+
+
+def wait_futures(futures: list, max_pending: int = 0):
+    # Block until at most max_pending submitted writes are still in flight, so converted arrays waiting for
+    # the disk do not pile up in memory. Failures of the finished writes are re-raised here.
+    while len(futures) > max_pending:
+        done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            future.result()
+        futures[:] = not_done
+
+
 class BaseModelConvert:
     def __init__(self):
         self.dtype = np.float32
@@ -79,6 +134,16 @@ class BaseModelConvert:
         else:
             raise Exception(f"{self.__class__.__name__} don't support convert weight to {dtype}.")
 
+    def get_torch_weight_data_type(self):
+        return torch.float16 if self.dtype == np.float16 else torch.float32
+
+    def to_np(self, param):
+        # Cast on the torch side so that fp16 weights never go through an intermediate fp32 numpy buffer.
+        # Transposed views are made contiguous here, so the file writes never have to reorder a strided array.
+        torch_dtype = self.get_torch_weight_data_type()
+        param = param.detach().to(dtype=torch_dtype, device="cpu").contiguous()
+        return param.numpy(force=True)
+
     # from_quantized_model: Convert from HuggingFace quantized int8/int4 model to xFT int8/int4 model.
     #     - "gptq" : Convert from AutoGPTQ quantized model.
     def convert(self, input_dir, output_dir=None, dtype: str = "fp16", processes=8, from_quantized_model=None):
@@ -14,6 +14,7 @@
 # ============================================================================
 
 import configparser
+import gc
 import multiprocessing
 import numpy as np
 import os
@@ -169,23 +170,29 @@ class LlamaConvert(BaseModelConvert):
             "mlp.down_proj.weight",
         ]
 
+        # the state_dict holds the only reference to each weight from here on, entries are dropped as soon as they
+        # are consumed so the q/k/v projections are freed once their merged QKV copy is built
         state_dict = model.state_dict()
+        del model
+        gc.collect()
         model_named_parameters = dict()
-        for name, param in state_dict.items():
+        for name in list(state_dict.keys()):
+            # k/v projections stay in state_dict until the QKV merge of their layer pops them
+            if "self_attn.k_proj.weight" in name or "self_attn.v_proj.weight" in name:
+                continue
+            param = state_dict.pop(name)
             print(f"name = {name}")
             # merge QKV
             if "self_attn.q_proj.weight" in name:
                 k_name = name.replace("q_proj", "k_proj")
                 v_name = name.replace("q_proj", "v_proj")
                 qkv = torch.cat(
-                    (param.permute(1, 0), state_dict[k_name].permute(1, 0), state_dict[v_name].permute(1, 0)), dim=1
+                    (param.permute(1, 0), state_dict.pop(k_name).permute(1, 0), state_dict.pop(v_name).permute(1, 0)),
+                    dim=1,
                 )
                 model_named_parameters[name.replace("self_attn.q_proj.weight", "attention.query_key_value.weight")] = (
                     qkv
                 )
-            # for merged weights, skip
-            elif "self_attn.k_proj.weight" in name or "self_attn.v_proj.weight" in name:
-                continue
             elif "embed" in name:
                 model_named_parameters[name] = param
             elif "lm_head" in name:
@@ -198,17 +205,14 @@ class LlamaConvert(BaseModelConvert):
                 model_named_parameters[name] = param.permute(1, 0) if len(param.shape) == 2 else param
 
         pool = multiprocessing.Pool(processes)
-        for name, param in model_named_parameters.items():
+        while model_named_parameters:
+            name, param = model_named_parameters.popitem()
             if name == "model.embed_tokens.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(os.path.join(output_dir, "model.wte.bin"))
+                self.to_np(param).tofile(os.path.join(output_dir, "model.wte.bin"))
             elif name == "model.norm.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.final_layernorm.weight.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.final_layernorm.weight.bin"))
             elif name == "lm_head.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.lm_head.weight.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.lm_head.weight.bin"))
             else:
                 starmap_args = []
                 for i in range(len(hf_model_name_pattern)):
@@ -221,7 +225,7 @@ class LlamaConvert(BaseModelConvert):
                                 output_dir,
                                 factor,
                                 new_name,
-                                param.detach().cpu().numpy().astype(self.dtype),
+                                self.to_np(param),
                                 num_attention_heads,
                                 num_key_value_heads,
                             )
@@ -395,15 +399,11 @@ class LlamaConvert(BaseModelConvert):
         pool = multiprocessing.Pool(processes)
         for name, param in model_named_parameters.items():
             if name == "model.embed_tokens.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(os.path.join(output_dir, "model.wte.bin"))
+                self.to_np(param).tofile(os.path.join(output_dir, "model.wte.bin"))
             elif name == "model.norm.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.final_layernorm.weight.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.final_layernorm.weight.bin"))
             elif name == "lm_head.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.lm_head.weight.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.lm_head.weight.bin"))
             else:
                 starmap_args = []
                 dtype = self.dtype
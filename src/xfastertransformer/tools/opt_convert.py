@@ -195,35 +195,25 @@ class OPTConvert(BaseModelConvert):
         padding_offset = 2
         for name, param in model_named_parameters.items():
             if name == "model.decoder.embed_positions.weight":
-                param[padding_offset:, ...].detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.wpe.bin")
-                )
+                self.to_np(param[padding_offset:, ...]).tofile(os.path.join(output_dir, "model.wpe.bin"))
 
             elif name == "model.decoder.embed_tokens.weight":
                 if "model.decoder.project_in.weight" in model_named_parameters.keys():
                     project_in = model_named_parameters["model.decoder.project_in.weight"]
                     project_out = model_named_parameters["model.decoder.project_out.weight"]
-                    torch.matmul(param, project_in).detach().cpu().numpy().astype(self.dtype).tofile(
-                        os.path.join(output_dir, "model.wte.bin")
-                    )
-                    torch.matmul(param, project_out).detach().cpu().numpy().astype(self.dtype).tofile(
+                    self.to_np(torch.matmul(param, project_in)).tofile(os.path.join(output_dir, "model.wte.bin"))
+                    self.to_np(torch.matmul(param, project_out)).tofile(
                         os.path.join(output_dir, "model.lm_head.weight.bin")
                     )
 
                 else:
-                    param.detach().cpu().numpy().astype(self.dtype).tofile(os.path.join(output_dir, "model.wte.bin"))
-                    param.detach().cpu().numpy().astype(self.dtype).tofile(
-                        os.path.join(output_dir, "model.lm_head.weight.bin")
-                    )
+                    self.to_np(param).tofile(os.path.join(output_dir, "model.wte.bin"))
+                    self.to_np(param).tofile(os.path.join(output_dir, "model.lm_head.weight.bin"))
 
             elif name == "model.decoder.final_layer_norm.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.final_layernorm.weight.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.final_layernorm.weight.bin"))
             elif name == "model.decoder.final_layer_norm.bias":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.final_layernorm.bias.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.final_layernorm.bias.bin"))
             elif "project_in" in name or "project_out" in name:
                 continue
             else:
@@ -240,7 +230,7 @@ class OPTConvert(BaseModelConvert):
                                 output_dir,
                                 factor,
                                 new_name,
-                                param.detach().cpu().numpy().astype(self.dtype),
+                                self.to_np(param),
                             )
                         )
                 pool.starmap_async(self.split_and_convert_process, starmap_args)
@@ -14,15 +14,15 @@
 # ============================================================================
 
 import configparser
-import multiprocessing
 import numpy as np
 import os
 import torch
 
+from concurrent.futures import ThreadPoolExecutor
 from transformers import AutoModelForCausalLM, AutoConfig
 from transformers.generation import GenerationConfig
 
-from .convert import BaseModelConvert, get_name_and_param
+from .convert import BaseModelConvert, get_name_and_param, has_safetensors, wait_futures, write_array
 
 
 class Qwen2Convert(BaseModelConvert):
@@ -44,7 +44,7 @@ class Qwen2Convert(BaseModelConvert):
                 path += "." + str(tp_num)
             path += ".bin"
 
-            val.tofile(path)
+            write_array(val, path)
 
         if (
             "input_layernorm.weight" in key
@@ -61,52 +61,68 @@ class Qwen2Convert(BaseModelConvert):
                 save_val(val, key)
 
         elif "mlp.gate_proj.weight" in key or "mlp.up_proj.weight" in key or "mlp.down_proj.weight" in key:
-            split_vals = np.split(val, factor, axis=0)
-            for j in range(factor):
-                save_val(split_vals[j], key, i * factor + j)
-
-        elif "attention.query_key_value.weight" in key:
-            qkvcols = val.shape[-1]
-            head_size = int(qkvcols / (int(num_attention_heads) + int(num_key_value_heads) * 2))
-            qcol = int(num_attention_heads) * head_size
-            kcol = int(num_key_value_heads) * head_size
-            vcol = int(num_key_value_heads) * head_size
-            qkv = np.split(val, [qcol, (qcol + kcol)], axis=-1)
-            q = qkv[0]
-            k = qkv[1]
-            v = qkv[2]
-            q_split_vals = np.split(q, factor, axis=-1)
-            k_split_vals = np.split(k, factor, axis=-1)
-            v_split_vals = np.split(v, factor, axis=-1)
-            for j in range(factor):
-                val = np.concatenate((q_split_vals[j], k_split_vals[j], v_split_vals[j]), axis=-1)
-                save_val(val, key, i * factor + j)
+            if factor == 1:
+                save_val(val, key, i)
+            else:
+                split_vals = np.split(val, factor, axis=0)
+                for j in range(factor):
+                    save_val(split_vals[j], key, i * factor + j)
 
-        elif "attention.query_key_value.bias" in key:
-            hidden_dim = val.shape[0]
-            head_size = int(hidden_dim / (int(num_attention_heads) + int(num_key_value_heads) * 2))
-            qcol = int(num_attention_heads) * head_size
-            kcol = int(num_key_value_heads) * head_size
-            vcol = int(num_key_value_heads) * head_size
-            qkv = np.split(val, [qcol, qcol + kcol])
-            q = qkv[0]
-            k = qkv[1]
-            v = qkv[2]
-            q_split_vals = np.split(q, factor, axis=-1)
-            k_split_vals = np.split(k, factor, axis=-1)
-            v_split_vals = np.split(v, factor, axis=-1)
-            for j in range(factor):
-                val = np.concatenate((q_split_vals[j], k_split_vals[j], v_split_vals[j]), axis=-1)
-                save_val(val, key, i * factor + j)
+        elif "attention.query_key_value.weight" in key or "attention.query_key_value.bias" in key:
+            if factor == 1:
+                # a single split is already laid out as [q|k|v]
+                save_val(val, key, i)
+            else:
+                qkvcols = val.shape[-1]
+                head_size = qkvcols // (num_attention_heads + num_key_value_heads * 2)
+                qcol = num_attention_heads * head_size
+                kcol = num_key_value_heads * head_size
+                vcol = num_key_value_heads * head_size
+                # each split is assembled from q/k/v slices of val into one buffer, no intermediate split lists
+                qc, kc, vc = qcol // factor, kcol // factor, vcol // factor
+                qkv = np.empty((*val.shape[:-1], qc + kc + vc), dtype=val.dtype)
+                for j in range(factor):
+                    q_off = j * qc
+                    k_off = qcol + j * kc
+                    v_off = qcol + kcol + j * vc
+                    np.copyto(qkv[..., :qc], val[..., q_off : q_off + qc])
+                    np.copyto(qkv[..., qc : qc + kc], val[..., k_off : k_off + kc])
+                    np.copyto(qkv[..., qc + kc :], val[..., v_off : v_off + vc])
+                    save_val(qkv, key, i * factor + j)
 
         elif "attention.dense.weight" in key:
-            split_vals = np.split(val, factor, axis=0)
-            for j in range(factor):
-                save_val(split_vals[j], key, i * factor + j)
+            if factor == 1:
+                save_val(val, key, i)
+            else:
+                split_vals = np.split(val, factor, axis=0)
+                for j in range(factor):
+                    save_val(split_vals[j], key, i * factor + j)
 
         else:
             print("[ERROR] cannot find key '{}'".format(key))
 
+    def load_name_and_param(self, input_dir, dtype):
+        if has_safetensors(input_dir):
+            yield from get_name_and_param(input_dir)
+            return
+
+        # checkpoints without safetensors (e.g. pytorch_model*.bin) are loaded through the HF model on CPU,
+        # every state_dict entry is dropped once it is handed out
+        model = AutoModelForCausalLM.from_pretrained(
+            input_dir,
+            load_in_8bit=False,
+            torch_dtype=torch.float16 if dtype == "fp16" else torch.float32,
+            low_cpu_mem_usage=True,
+            device_map={"": "cpu"},
+            trust_remote_code=True,
+        )
+        state_dict = model.state_dict()
+        del model
+        if not state_dict:
+            raise Exception(f"No weights found in {input_dir}.")
+        for name in list(state_dict.keys()):
+            yield name, state_dict.pop(name)
+
     def split_and_convert(self, input_dir, output_dir, dtype, processes):
         saved_dir = output_dir
 
@@ -114,21 +130,12 @@ class Qwen2Convert(BaseModelConvert):
         if not os.path.exists(saved_dir):
             os.makedirs(saved_dir)
 
-        # load the model
+        # load the model config, weights are streamed by load_name_and_param below
         gen_config = GenerationConfig.from_pretrained(input_dir, trust_remote_code=True, resume_download=True)
         hf_config, _ = AutoConfig.from_pretrained(
             input_dir, return_unused_kwargs=True, trust_remote_code=True, fp16=True, use_flash_attn=False
         )
 
-        # load the model
-        model = AutoModelForCausalLM.from_pretrained(
-            input_dir,
-            load_in_8bit=False,
-            torch_dtype=torch.float16,
-            low_cpu_mem_usage=True,
-            device_map="auto",
-        )
-
         hf_config = {
             **vars(gen_config),
             **vars(hf_config),
@@ -168,101 +175,118 @@ class Qwen2Convert(BaseModelConvert):
             print("Fail to save the config in config.ini.", str(e))
             exit(-1)
 
-        hf_model_name_pattern = [
-            "input_layernorm.weight",
-            "attention.query_key_value.weight",
-            "attention.query_key_value.bias",
-            "self_attn.o_proj.weight",
-            "post_attention_layernorm.weight",
-            "mlp.gate_proj.weight",
-            "mlp.up_proj.weight",
-            "mlp.down_proj.weight",
-        ]
+        # per-layer weight names, as produced by the QKV merge in the loop below, mapped to their xFT names
+        layer_weight_names = {
+            "input_layernorm.weight": "input_layernorm.weight",
+            "attention.query_key_value.weight": "attention.query_key_value.weight",
+            "attention.query_key_value.bias": "attention.query_key_value.bias",
+            "self_attn.o_proj.weight": "attention.dense.weight",
+            "post_attention_layernorm.weight": "post_attention_layernorm.weight",
+            "mlp.gate_proj.weight": "mlp.gate_proj.weight",
+            "mlp.up_proj.weight": "mlp.up_proj.weight",
+            "mlp.down_proj.weight": "mlp.down_proj.weight",
+        }
 
-        ft_model_name_pattern = [
-            "input_layernorm.weight",
-            "attention.query_key_value.weight",
-            "attention.query_key_value.bias",
-            "attention.dense.weight",
-            "post_attention_layernorm.weight",
-            "mlp.gate_proj.weight",
-            "mlp.up_proj.weight",
-            "mlp.down_proj.weight",
-        ]
+        # head numbers are kept as strings for config.ini, convert them once for the split workers
+        num_attention_heads = int(num_attention_heads)
+        num_key_value_heads = int(num_key_value_heads)
 
         print("Processing ...")
-        state_dict = model.state_dict()
-        model_named_parameters = dict()
-        for name, param in state_dict.items():
-            # print(f"name = {name}")
+        # q/k/v projections are merged into one tensor, hold them until all of a layer's parts are loaded
+        # since they may live in different safetensors shards
+        qkv_parts = dict()
+        # the shard writes are I/O bound and release the GIL, threads avoid pickling every array to a worker process
+        # never start more writers than there are per-layer tensors to write
+        n_tasks = hf_config["num_hidden_layers"] * len(layer_weight_names)
+        n_workers = min(processes, max(1, n_tasks))
+        executor = ThreadPoolExecutor(max_workers=n_workers)
+        # the next tensors are converted while earlier ones are written, bounded to cap the host memory in flight
+        max_pending = 2 * n_workers
+        futures = []
+        # tied checkpoints usually do not store lm_head, the embedding is written as lm_head at the end if none is seen
+        tie_word_embeddings = hf_config.get("tie_word_embeddings", False)
+        tied_lm_head = None
+        has_lm_head = False
+        for name, param in self.load_name_and_param(input_dir, dtype):
             # merge QKV
-            if "self_attn.q_proj.weight" in name:
-                k_name = name.replace("q_proj", "k_proj")
-                v_name = name.replace("q_proj", "v_proj")
-                qkv = torch.cat(
-                    (param.permute(1, 0), state_dict[k_name].permute(1, 0), state_dict[v_name].permute(1, 0)), dim=1
-                )
-                model_named_parameters[name.replace("self_attn.q_proj.weight", "attention.query_key_value.weight")] = (
-                    qkv
-                )
-            # for merged weights, skip
-            elif "self_attn.k_proj.weight" in name or "self_attn.v_proj.weight" in name:
-                continue
-            # merge QKV bias
-            if "self_attn.q_proj.bias" in name:
-                print(f"name = {name}")
-                k_name = name.replace("q_proj", "k_proj")
-                v_name = name.replace("q_proj", "v_proj")
-                qkv_bias = torch.cat((param, state_dict[k_name], state_dict[v_name]))
-                model_named_parameters[name.replace("self_attn.q_proj.bias", "attention.query_key_value.bias")] = (
-                    qkv_bias
-                )
-            # for merged weights, skip
-            elif "self_attn.k_proj.bias" in name or "self_attn.v_proj.bias" in name:
-                continue
-            elif "embed" in name:
-                model_named_parameters[name] = param
-            elif "lm_head" in name:
-                model_named_parameters[name] = param
+            if "self_attn.q_proj" in name or "self_attn.k_proj" in name or "self_attn.v_proj" in name:
+                qkv_parts[name] = param
+                q_name = name.replace("k_proj", "q_proj").replace("v_proj", "q_proj")
+                k_name = q_name.replace("q_proj", "k_proj")
+                v_name = q_name.replace("q_proj", "v_proj")
+                if q_name not in qkv_parts or k_name not in qkv_parts or v_name not in qkv_parts:
+                    continue
+                q, k, v = qkv_parts.pop(q_name), qkv_parts.pop(k_name), qkv_parts.pop(v_name)
+                if "self_attn.q_proj.weight" in q_name:
+                    name = q_name.replace("self_attn.q_proj.weight", "attention.query_key_value.weight")
+                    # copy the transposed q/k/v straight into their slices of the merged tensor, casting
+                    # to the weight data type on the way
+                    qcol, kcol = q.shape[0], k.shape[0]
+                    param = torch.empty((q.shape[1], qcol + kcol + v.shape[0]), dtype=self.get_torch_weight_data_type())
+                    param[:, :qcol].copy_(q.t())
+                    param[:, qcol : qcol + kcol].copy_(k.t())
+                    param[:, qcol + kcol :].copy_(v.t())
+                else:
+                    name = q_name.replace("self_attn.q_proj.bias", "attention.query_key_value.bias")
+                    param = torch.cat((q, k, v))
+                del q, k, v
+            elif "embed" in name or "lm_head" in name:
+                pass
             elif "gemma" in sec_name and "norm" in name:
-                model_named_parameters[name] = param + 1
+                param = param + 1
             elif "layernorm" in name:
-                model_named_parameters[name] = param
+                pass
             else:
-                model_named_parameters[name] = param.permute(1, 0) if len(param.shape) == 2 else param
+                param = param.t() if len(param.shape) == 2 else param
 
-        pool = multiprocessing.Pool(processes)
-        for name, param in model_named_parameters.items():
-            param = param.half()
             if name == "model.embed_tokens.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(os.path.join(output_dir, "model.wte.bin"))
+                wte = self.to_np(param)
+                futures.append(executor.submit(write_array, wte, os.path.join(output_dir, "model.wte.bin")))
+                if tie_word_embeddings and not has_lm_head:
+                    tied_lm_head = wte
+                del wte
             elif name == "model.norm.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.final_layernorm.weight.bin")
+                futures.append(
+                    executor.submit(
+                        write_array, self.to_np(param), os.path.join(output_dir, "model.final_layernorm.weight.bin")
+                    )
                 )
             elif name == "lm_head.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(saved_dir, "model.lm_head.weight.bin")
+                has_lm_head = True
+                tied_lm_head = None
+                futures.append(
+                    executor.submit(write_array, self.to_np(param), os.path.join(saved_dir, "model.lm_head.weight.bin"))
                 )
             else:
-                starmap_args = []
-                for i in range(len(hf_model_name_pattern)):
-                    if hf_model_name_pattern[i] in name:
-                        factor = 1
-                        new_name = name.replace(hf_model_name_pattern[i], ft_model_name_pattern[i])
-                        starmap_args.append(
-                            (
-                                0,
-                                saved_dir,
-                                factor,
-                                new_name,
-                                param.detach().cpu().numpy().astype(self.dtype),
-                                num_attention_heads,
-                                num_key_value_heads,
-                            )
+                # model.layers.{layer id}.{weight name}
+                parts = name.split(".", 3)
+                is_layer = len(parts) == 4 and parts[:2] == ["model", "layers"] and parts[2].isdigit()
+                ft_name = layer_weight_names.get(parts[3]) if is_layer else None
+                if ft_name is None:
+                    print("[ERROR] cannot find key '{}'".format(name))
+                else:
+                    factor = 1
+                    new_name = "model.layers.{}.{}".format(parts[2], ft_name)
+                    futures.append(
+                        executor.submit(
+                            self.split_and_convert_process,
+                            0,
+                            saved_dir,
+                            factor,
+                            new_name,
+                            self.to_np(param),
+                            num_attention_heads,
+                            num_key_value_heads,
                         )
-                pool.starmap_async(self.split_and_convert_process, starmap_args)
-        pool.close()
-        pool.join()
+                    )
+            del param
+            wait_futures(futures, max_pending)
+        if tied_lm_head is not None:
+            futures.append(
+                executor.submit(write_array, tied_lm_head, os.path.join(saved_dir, "model.lm_head.weight.bin"))
+            )
+            del tied_lm_head
+        wait_futures(futures)
+        executor.shutdown(wait=True)
 
         print(f"{saved_dir} export successful!")
@@ -14,15 +14,15 @@
 # ============================================================================
 
 import configparser
-import multiprocessing
 import numpy as np
 import os
 import torch
 
+from concurrent.futures import ThreadPoolExecutor
 from transformers import AutoModelForCausalLM, AutoConfig
 from transformers.generation import GenerationConfig
 
-from .convert import BaseModelConvert, get_name_and_param
+from .convert import BaseModelConvert, get_name_and_param, wait_futures, write_array
 
 
 class QwenConvert(BaseModelConvert):
@@ -44,7 +44,7 @@ class QwenConvert(BaseModelConvert):
                 path += "." + str(tp_num)
             path += ".bin"
 
-            val.tofile(path)
+            write_array(val, path)
 
         if (
             "input_layernorm.weight" in key
@@ -61,48 +61,42 @@ class QwenConvert(BaseModelConvert):
                 save_val(val, key)
 
         elif "mlp.gate_proj.weight" in key or "mlp.up_proj.weight" in key or "mlp.down_proj.weight" in key:
-            split_vals = np.split(val, factor, axis=0)
-            for j in range(factor):
-                save_val(split_vals[j], key, i * factor + j)
-
-        elif "attention.query_key_value.weight" in key:
-            qkvcols = val.shape[-1]
-            head_size = int(qkvcols / (int(num_attention_heads) + int(num_key_value_heads) * 2))
-            qcol = int(num_attention_heads) * head_size
-            kcol = int(num_key_value_heads) * head_size
-            vcol = int(num_key_value_heads) * head_size
-            qkv = np.split(val, [qcol, (qcol + kcol)], axis=-1)
-            q = qkv[0]
-            k = qkv[1]
-            v = qkv[2]
-            q_split_vals = np.split(q, factor, axis=-1)
-            k_split_vals = np.split(k, factor, axis=-1)
-            v_split_vals = np.split(v, factor, axis=-1)
-            for j in range(factor):
-                val = np.concatenate((q_split_vals[j], k_split_vals[j], v_split_vals[j]), axis=-1)
-                save_val(val, key, i * factor + j)
-
-        elif "attention.query_key_value.bias" in key:
-            hidden_dim = val.shape[0]
-            head_size = int(hidden_dim / (int(num_attention_heads) + int(num_key_value_heads) * 2))
-            qcol = int(num_attention_heads) * head_size
-            kcol = int(num_key_value_heads) * head_size
-            vcol = int(num_key_value_heads) * head_size
-            qkv = np.split(val, [qcol, qcol + kcol])
-            q = qkv[0]
-            k = qkv[1]
-            v = qkv[2]
-            q_split_vals = np.split(q, factor, axis=-1)
-            k_split_vals = np.split(k, factor, axis=-1)
-            v_split_vals = np.split(v, factor, axis=-1)
-            for j in range(factor):
-                val = np.concatenate((q_split_vals[j], k_split_vals[j], v_split_vals[j]), axis=-1)
-                save_val(val, key, i * factor + j)
+            if factor == 1:
+                save_val(val, key, i)
+            else:
+                split_vals = np.split(val, factor, axis=0)
+                for j in range(factor):
+                    save_val(split_vals[j], key, i * factor + j)
+
+        elif "attention.query_key_value.weight" in key or "attention.query_key_value.bias" in key:
+            if factor == 1:
+                # a single split is already laid out as [q|k|v]
+                save_val(val, key, i)
+            else:
+                qkvcols = val.shape[-1]
+                head_size = qkvcols // (num_attention_heads + num_key_value_heads * 2)
+                qcol = num_attention_heads * head_size
+                kcol = num_key_value_heads * head_size
+                vcol = num_key_value_heads * head_size
+                # each split is assembled from q/k/v slices of val into one buffer, no intermediate split lists
+                qc, kc, vc = qcol // factor, kcol // factor, vcol // factor
+                qkv = np.empty((*val.shape[:-1], qc + kc + vc), dtype=val.dtype)
+                for j in range(factor):
+                    q_off = j * qc
+                    k_off = qcol + j * kc
+                    v_off = qcol + kcol + j * vc
+                    np.copyto(qkv[..., :qc], val[..., q_off : q_off + qc])
+                    np.copyto(qkv[..., qc : qc + kc], val[..., k_off : k_off + kc])
+                    np.copyto(qkv[..., qc + kc :], val[..., v_off : v_off + vc])
+                    save_val(qkv, key, i * factor + j)
 
         elif "attention.dense.weight" in key:
-            split_vals = np.split(val, factor, axis=0)
-            for j in range(factor):
-                save_val(split_vals[j], key, i * factor + j)
+            if factor == 1:
+                save_val(val, key, i)
+            else:
+                split_vals = np.split(val, factor, axis=0)
+                for j in range(factor):
+                    save_val(split_vals[j], key, i * factor + j)
 
         else:
             print("[ERROR] cannot find key '{}'".format(key))
@@ -161,77 +155,82 @@ class QwenConvert(BaseModelConvert):
             print("Fail to save the config in config.ini.", str(e))
             exit(-1)
 
-        hf_model_name_pattern = [
-            "ln_1.weight",
-            "attn.c_attn.weight",
-            "attn.c_attn.bias",
-            "attn.c_proj.weight",
-            "ln_2.weight",
-            "mlp.w2.weight",
-            "mlp.w1.weight",
-            "mlp.c_proj.weight",
-        ]
-
-        ft_model_name_pattern = [
-            "input_layernorm.weight",
-            "attention.query_key_value.weight",
-            "attention.query_key_value.bias",
-            "attention.dense.weight",
-            "post_attention_layernorm.weight",
-            "mlp.gate_proj.weight",
-            "mlp.up_proj.weight",
-            "mlp.down_proj.weight",
-        ]
+        # per-layer weight names mapped to their xFT names
+        layer_weight_names = {
+            "ln_1.weight": "input_layernorm.weight",
+            "attn.c_attn.weight": "attention.query_key_value.weight",
+            "attn.c_attn.bias": "attention.query_key_value.bias",
+            "attn.c_proj.weight": "attention.dense.weight",
+            "ln_2.weight": "post_attention_layernorm.weight",
+            "mlp.w2.weight": "mlp.gate_proj.weight",
+            "mlp.w1.weight": "mlp.up_proj.weight",
+            "mlp.c_proj.weight": "mlp.down_proj.weight",
+        }
+
+        # head numbers are kept as strings for config.ini, convert them once for the split workers
+        num_attention_heads = int(num_attention_heads)
+        num_key_value_heads = int(num_key_value_heads)
 
         print("Processing ...")
-        pool = multiprocessing.Pool(processes)
+        # the shard writes are I/O bound and release the GIL, threads avoid pickling every array to a worker process
+        # never start more writers than there are per-layer tensors to write
+        n_tasks = hf_config["num_hidden_layers"] * len(layer_weight_names)
+        n_workers = min(processes, max(1, n_tasks))
+        executor = ThreadPoolExecutor(max_workers=n_workers)
+        # the next tensors are converted while earlier ones are written, bounded to cap the host memory in flight
+        max_pending = 2 * n_workers
+        futures = []
         for name, param in get_name_and_param(input_dir):
-            param = param.half()
             if "embed" in name or "lm_head" in name:
                 pass
             else:
-                param = param.permute(1, 0) if len(param.shape) == 2 else param
+                param = param.t() if len(param.shape) == 2 else param
 
             # print(f"name = {name} param = {type(param)} {param.dtype} ")
 
             if name == "transformer.wte.weight":
                 if len(param.shape) == 2:
                     if param.shape[0] == hidden_size:
-                        param.detach().cpu().numpy().astype(self.dtype).transpose().tofile(
-                            os.path.join(saved_dir, "model.wte.bin")
-                        )
-                    else:
-                        param.detach().cpu().numpy().astype(self.dtype).tofile(os.path.join(saved_dir, "model.wte.bin"))
+                        param = param.t()
+                    futures.append(
+                        executor.submit(write_array, self.to_np(param), os.path.join(saved_dir, "model.wte.bin"))
+                    )
                 else:
                     print("[ERROR] embedding table shape dims is not 2.")
             elif name == "transformer.ln_f.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(saved_dir, "model.final_layernorm.weight.bin")
+                futures.append(
+                    executor.submit(
+                        write_array, self.to_np(param), os.path.join(saved_dir, "model.final_layernorm.weight.bin")
+                    )
                 )
             elif name == "lm_head.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(saved_dir, "model.lm_head.weight.bin")
+                futures.append(
+                    executor.submit(write_array, self.to_np(param), os.path.join(saved_dir, "model.lm_head.weight.bin"))
                 )
             else:
-                starmap_args = []
-                for i in range(len(hf_model_name_pattern)):
-                    if hf_model_name_pattern[i] in name:
-                        factor = 1
-                        new_name = name.replace("transformer.h", "model.layers")
-                        new_name = new_name.replace(hf_model_name_pattern[i], ft_model_name_pattern[i])
-                        starmap_args.append(
-                            (
-                                0,
-                                saved_dir,
-                                factor,
-                                new_name,
-                                param.detach().cpu().numpy().astype(self.dtype),
-                                num_attention_heads,
-                                num_key_value_heads,
-                            )
+                # transformer.h.{layer id}.{weight name}
+                parts = name.split(".", 3)
+                is_layer = len(parts) == 4 and parts[:2] == ["transformer", "h"] and parts[2].isdigit()
+                ft_name = layer_weight_names.get(parts[3]) if is_layer else None
+                if ft_name is None:
+                    print("[ERROR] cannot find key '{}'".format(name))
+                else:
+                    factor = 1
+                    new_name = "model.layers.{}.{}".format(parts[2], ft_name)
+                    futures.append(
+                        executor.submit(
+                            self.split_and_convert_process,
+                            0,
+                            saved_dir,
+                            factor,
+                            new_name,
+                            self.to_np(param),
+                            num_attention_heads,
+                            num_key_value_heads,
                         )
-                pool.starmap_async(self.split_and_convert_process, starmap_args)
-        pool.close()
-        pool.join()
+                    )
+            wait_futures(futures, max_pending)
+        wait_futures(futures)
+        executor.shutdown(wait=True)
 
         print(f"{saved_dir} export successful!")
@@ -216,15 +216,11 @@ class YaRNLlamaConvert(BaseModelConvert):
         pool = multiprocessing.Pool(processes)
         for name, param in model_named_parameters.items():
             if name == "model.embed_tokens.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(os.path.join(output_dir, "model.wte.bin"))
+                self.to_np(param).tofile(os.path.join(output_dir, "model.wte.bin"))
             elif name == "model.norm.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.final_layernorm.weight.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.final_layernorm.weight.bin"))
             elif name == "lm_head.weight":
-                param.detach().cpu().numpy().astype(self.dtype).tofile(
-                    os.path.join(output_dir, "model.lm_head.weight.bin")
-                )
+                self.to_np(param).tofile(os.path.join(output_dir, "model.lm_head.weight.bin"))
             else:
                 starmap_args = []
                 for i in range(len(hf_model_name_pattern)):
@@ -237,7 +233,7 @@ class YaRNLlamaConvert(BaseModelConvert):
                                 output_dir,
                                 factor,
                                 new_name,
-                                param.detach().cpu().numpy().astype(self.dtype),
+                                self.to_np(param),
                                 num_attention_heads,
                                 num_key_value_heads,
                             )